@@ -1,25 +1,50 @@
-import os, json, threading, uuid, subprocess
+import os, re, shutil, signal, threading, uuid, zipfile, subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from flask import Flask, request, jsonify, send_file
+import orjson
+from flask import Flask, Response, request, send_file
 from flask_cors import CORS
+from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
+from redis import Redis, RedisError
+from rq import Queue
 
-from sqlalchemy import create_engine, String, Integer, Float, Text, ForeignKey
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session
+from sqlalchemy import create_engine, event, select, String, Integer, Float, Text, ForeignKey
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, selectinload, Session
 
 # ---------------------------------
 # Load configuration
 # ---------------------------------
 load_dotenv()
 API_PORT = int(os.getenv("API_PORT", "5050"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# gunicorn (the container's server) already streams artifacts with sendfile(2).
+# Only enable behind a front server that honours X-Sendfile (Apache with mod_xsendfile,
+# lighttpd); artifact responses then carry no body of their own. nginx ignores this
+# header (it uses X-Accel-Redirect), so leave it off behind nginx.
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE", "0") == "1"
 
 QC_ROOT = Path(os.getenv("QC_ROOT", "/data/qc"))
 STORAGE_ROOT = Path(os.getenv("STORAGE_ROOT", "/data/storage"))
 STAR_GENOME_DIR = Path(os.getenv("STAR_GENOME_DIR", "/refs/star_index"))
 # Match your docker-compose default: /refs/genomic.gtf
 GTF_PATH = Path(os.getenv("GTF_PATH", "/refs/genomic.gtf"))
+# Keep the STAR index resident in shared memory between runs.
+# Set to NoSharedMemory on hosts where SysV shared memory is restricted.
+STAR_GENOME_LOAD = os.getenv("STAR_GENOME_LOAD", "LoadAndKeep")
+# Shared-memory genomes can't sort BAMs in the genome's memory; STAR needs an explicit budget.
+STAR_BAM_SORT_RAM = os.getenv("STAR_BAM_SORT_RAM", "10000000000")
+# Threads per job, split evenly between the jobs that may run at once (one per worker).
+# sched_getaffinity respects container CPU sets; cpu_count() reports the whole host.
+JOB_CONCURRENCY = max(1, int(os.getenv("JOB_CONCURRENCY", "1")))
+CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 4)
+THREADS = max(1, CPUS // JOB_CONCURRENCY)
+# fastp caps itself at 16 workers and featureCounts scales poorly beyond that
+FC_THREADS = min(THREADS, 16)
 
 UPLOAD_DIR = STORAGE_ROOT / "uploads"
 ARTIFACTS_DIR = STORAGE_ROOT / "artifacts"
@@ -56,7 +81,7 @@ class Run(Base):
 class Stage(Base):
     __tablename__ = "stages"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    run_id: Mapped[str] = mapped_column(ForeignKey("runs.id", ondelete="CASCADE"))
+    run_id: Mapped[str] = mapped_column(ForeignKey("runs.id", ondelete="CASCADE"), index=True)
     name: Mapped[str] = mapped_column(String(64))
     status: Mapped[str] = mapped_column(String(32), default="running")
     progress: Mapped[float] = mapped_column(Float, default=0.0)
@@ -68,13 +93,47 @@ class Stage(Base):
 class Artifact(Base):
     __tablename__ = "artifacts"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    run_id: Mapped[str] = mapped_column(ForeignKey("runs.id", ondelete="CASCADE"))
+    run_id: Mapped[str] = mapped_column(ForeignKey("runs.id", ondelete="CASCADE"), index=True)
     kind: Mapped[str] = mapped_column(String(64))
     path: Mapped[str] = mapped_column(Text)
     run: Mapped[Run] = relationship(back_populates="artifacts")
 
-engine = create_engine(f"sqlite:///{DB_PATH}", echo=False, future=True)
-Base.metadata.create_all(engine)
+engine = create_engine(
+    f"sqlite:///{DB_PATH}", echo=False, future=True,
+    poolclass=QueuePool, pool_size=8, max_overflow=16,
+    connect_args={"check_same_thread": False, "timeout": 30},
+)
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _):
+    # WAL + NORMAL: stage commits no longer fsync the whole journal every time
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA busy_timeout=30000")
+    cur.close()
+
+def create_schema():
+    Base.metadata.create_all(engine)
+    # create_all only indexes tables it creates; add the run_id indexes to existing databases too
+    for table in (Stage.__table__, Artifact.__table__):
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+# The API and worker containers import this module at the same time. On a fresh
+# database both can pass the existence checks and the loser fails with
+# "already exists"; by then the schema is there, so checking again is a no-op.
+try:
+    create_schema()
+except OperationalError:
+    create_schema()
+
+# ---------------------------------
+# Job queue (consumed by worker.py)
+# ---------------------------------
+queue = Queue("pipeline", connection=Redis.from_url(REDIS_URL))
 
 # ---------------------------------
 # Flask setup
@@ -82,6 +141,7 @@ Base.metadata.create_all(engine)
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 app.config["MAX_CONTENT_LENGTH"] = 2 * 1024 * 1024 * 1024  # 2GB
+app.config["USE_X_SENDFILE"] = USE_X_SENDFILE
 
 # ---------------------------------
 # Helpers
@@ -89,9 +149,64 @@ app.config["MAX_CONTENT_LENGTH"] = 2 * 1024 * 1024 * 1024  # 2GB
 def now_iso():
     return datetime.utcnow().isoformat() + "Z"
 
-def sh(cmd, cwd=None):
-    p = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True)
-    return p.returncode, p.stdout, p.stderr
+def json_response(obj):
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
+STDERR_TAIL = 64 * 1024
+
+def wait_tail(p: subprocess.Popen):
+    """Wait for `p`, keeping only the last STDERR_TAIL bytes of its stderr."""
+    tail = b""
+    for chunk in iter(lambda: p.stderr.read(STDERR_TAIL), b""):
+        tail = (tail + chunk)[-STDERR_TAIL:]
+    return p.wait(), tail.decode(errors="replace")
+
+def sh(cmd, cwd=None, log_path=None):
+    with open(log_path or os.devnull, "wb") as log:
+        p = subprocess.Popen(cmd, cwd=cwd, stdout=log, stderr=subprocess.PIPE)
+        return wait_tail(p)
+
+def tee_fifo(src: Path, dst: Path, gz: Path, threads: int):
+    """Forward FASTQ from FIFO `src` into FIFO `dst`, keeping a gzipped copy at `gz`."""
+    return subprocess.Popen(
+        ["sh", "-c", 'tee "$1" < "$0" | pigz -1 -p "$3" -c > "$2"',
+         str(src), str(dst), str(gz), str(threads)],
+        stderr=subprocess.PIPE, start_new_session=True,
+    )
+
+def fused_threads(mates: int):
+    """Split THREADS across the fastp -> STAR stage: (STAR, fastp, pigz per mate).
+
+    fastp and pigz mostly sit blocked on the pipe into STAR, so they get small
+    capped shares and STAR the rest. On small boxes STAR keeps at least 3/4 of
+    THREADS, even though that slightly oversubscribes. Post-trim FastQC (-t one
+    per mate) only starts once fastp and pigz have exited, so it runs on their
+    threads while STAR sorts the BAM.
+    """
+    fastp = min(8, max(1, THREADS // 8))
+    pigz = min(4, max(1, THREADS // 16))
+    star = max(1, THREADS - fastp - pigz * mates, THREADS * 3 // 4)
+    return star, fastp, pigz
+
+def kill_group(p: subprocess.Popen):
+    if p.poll() is None:
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # exited (and was reaped elsewhere) since poll()
+    p.wait()
+
+def star_genome(mode):
+    """Load (LoadAndExit) or drop (Remove) the shared-memory STAR genome."""
+    if STAR_GENOME_LOAD == "NoSharedMemory":
+        return
+    out_dir = QC_ROOT / "_star_genome"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    sh([
+        "STAR", "--genomeLoad", mode,
+        "--genomeDir", str(STAR_GENOME_DIR),
+        "--outFileNamePrefix", f"{out_dir}/"
+    ], cwd=out_dir)
 
 def run_to_dict(r: Run):
     return {
@@ -101,16 +216,16 @@ def run_to_dict(r: Run):
         "progress": r.progress,
         "sample": {
             "name": r.sample_name,
-            "files": json.loads(r.sample_files_json or "[]"),
+            "files": orjson.loads(r.sample_files_json or "[]"),
         },
-        "params": json.loads(r.params_json or "{}"),
+        "params": orjson.loads(r.params_json or "{}"),
         "stages": [
             {
                 "name": s.name,
                 "status": s.status,
                 "progress": s.progress,
                 "time": s.time_iso,
-                "metrics": json.loads(s.metrics_json or "{}"),
+                "metrics": orjson.loads(s.metrics_json or "{}"),
                 "artifact": s.artifact_path or None,
             }
             for s in r.stages
@@ -118,27 +233,33 @@ def run_to_dict(r: Run):
         "artifacts": [{"kind": a.kind, "path": a.path} for a in r.artifacts],
     }
 
-def parse_fastqc_summary(dir: Path):
-    out = {}
-    f = dir / "summary.txt"
-    if not f.exists():
-        return out
-    for line in f.read_text().splitlines():
-        parts = line.split("\t")
-        if len(parts) >= 3:
-            status, metric, _ = parts[:3]
-            out[metric] = status
-    return out
+# summary.txt rows are "STATUS<TAB>Module<TAB>file"; Log.final.out rows are "key | value"
+_FQC_RE = re.compile(rb"^([^\t\n]+)\t([^\t\n]+)\t", re.M)
+_STAR_RE = re.compile(rb"^[ \t]*([^|\n]*?)[ \t]*\|[ \t]*([^\n]*?)[ \t]*$", re.M)
+
+def parse_fastqc_summary(zp: Path):
+    """Read summary.txt straight out of FastQC's <prefix>_fastqc.zip."""
+    if not zp.exists():
+        return {}
+    try:
+        with zipfile.ZipFile(zp) as z:
+            data = z.read(f"{zp.stem}/summary.txt")
+    except (zipfile.BadZipFile, KeyError):
+        return {}  # truncated zip (FastQC killed) or no summary
+    return {m.group(2).decode(): m.group(1).decode() for m in _FQC_RE.finditer(data)}
 
 def parse_star_log(f: Path):
     if not f.exists():
         return {}
-    out = {}
-    for line in f.read_text().splitlines():
-        if "|" in line:
-            k, v = line.split("|", 1)
-            out[k.strip()] = v.strip()
-    return out
+    return {m.group(1).decode(): m.group(2).decode() for m in _STAR_RE.finditer(f.read_bytes())}
+
+def load_run(session: Session, job_id: str):
+    """Fetch a run with its stages and artifacts in one round trip per collection."""
+    return session.execute(
+        select(Run)
+        .options(selectinload(Run.stages), selectinload(Run.artifacts))
+        .where(Run.id == job_id)
+    ).scalar_one_or_none()
 
 def _emit_stage(session: Session, run: Run, name, pct, metrics=None, artifact=None, status="running"):
     st = Stage(
@@ -147,7 +268,7 @@ def _emit_stage(session: Session, run: Run, name, pct, metrics=None, artifact=No
         status=status,
         progress=pct,
         time_iso=now_iso(),
-        metrics_json=json.dumps(metrics or {}),
+        metrics_json=orjson.dumps(metrics or {}).decode(),
         artifact_path=str(artifact or "")
     )
     session.add(st)
@@ -155,15 +276,28 @@ def _emit_stage(session: Session, run: Run, name, pct, metrics=None, artifact=No
     run.status = "finished" if pct >= 100 else "running"
     session.commit()
 
-def _add_fastqc_plots(session: Session, run: Run, images_dir: Path, tag: str):
-    if not images_dir.exists():
+def _add_fastqc_plots(session: Session, run: Run, zp: Path, tag: str):
+    # Only the plot PNGs are unpacked (to <prefix>_fastqc/Images/, as --extract would)
+    if not zp.exists():
         return
-    for png in sorted(images_dir.glob("*.png")):
-        session.add(Artifact(
+    try:
+        with zipfile.ZipFile(zp) as z:
+            pngs = sorted(
+                n for n in z.namelist()
+                if n.startswith(f"{zp.stem}/Images/") and n.endswith(".png")
+            )
+            for name in pngs:
+                z.extract(name, zp.parent)
+    except zipfile.BadZipFile:
+        return
+    session.add_all([
+        Artifact(
             run_id=run.id,
-            kind=f"fastqc_plot_{tag}:{png.stem}",
-            path=str(png)
-        ))
+            kind=f"fastqc_plot_{tag}:{Path(name).stem}",
+            path=str(zp.parent / name)
+        )
+        for name in pngs
+    ])
     session.commit()
 
 # ---------------------------------
@@ -171,31 +305,41 @@ def _add_fastqc_plots(session: Session, run: Run, images_dir: Path, tag: str):
 # ---------------------------------
 @app.get("/api/health")
 def health():
-    return jsonify({"ok": True, "time": now_iso()})
+    return json_response({"ok": True, "time": now_iso()})
 
 @app.post("/api/upload")
 def upload():
+    # Reject oversized uploads before the multipart body is parsed
+    if (request.content_length or 0) > app.config["MAX_CONTENT_LENGTH"]:
+        return json_response({"ok": False, "error": "upload too large"}), 413
+
     if "files" not in request.files:
-        return jsonify({"ok": False, "error": "no files"}), 400
+        return json_response({"ok": False, "error": "no files"}), 400
 
     files = request.files.getlist("files")
-    name = request.form.get("sample_name") or f"sample-{uuid.uuid4().hex[:6]}"
+    name = secure_filename(request.form.get("sample_name") or "") or f"sample-{uuid.uuid4().hex[:6]}"
     destdir = UPLOAD_DIR / name
     destdir.mkdir(parents=True, exist_ok=True)
 
     saved = []
     for f in files:
-        safe = f.filename.replace("..", "_")
+        safe = secure_filename(f.filename or "") or f"u-{uuid.uuid4().hex}"
         path = destdir / safe
-        f.save(path)
+        with open(path, "wb") as out:
+            shutil.copyfileobj(f.stream, out, length=1 << 20)
         saved.append(str(path))
 
-    return jsonify({"ok": True, "sample": {"name": name, "files": saved}})
+    return json_response({"ok": True, "sample": {"name": name, "files": saved}})
 
 @app.post("/api/run")
 def run_pipeline():
-    data = request.json
-    sample = data["sample"]
+    try:
+        data = orjson.loads(request.get_data())
+        sample = data["sample"]
+        name, files = sample["name"], sample["files"]
+        params = data.get("params", {})
+    except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError):
+        return json_response({"ok": False, "error": "invalid JSON"}), 400
 
     job_id = uuid.uuid4().hex
     r = Run(
@@ -203,47 +347,52 @@ def run_pipeline():
         created_at=now_iso(),
         status="queued",
         progress=0,
-        sample_name=sample["name"],
-        sample_files_json=json.dumps(sample["files"]),
-        params_json=json.dumps(data.get("params", {}))
+        sample_name=name,
+        sample_files_json=orjson.dumps(files).decode(),
+        params_json=orjson.dumps(params).decode()
     )
 
     with Session(engine) as s:
         s.add(r)
         s.commit()
 
-    threading.Thread(target=_run_pipeline_real, args=(job_id,), daemon=True).start()
+        try:
+            # Referenced by name: when served via `python app.py` this module is __main__
+            queue.enqueue("app._run_pipeline_real", job_id, job_timeout=-1)
+        except RedisError:
+            # No worker will ever pick this run up; don't leave it "queued"
+            r.status = "failed"
+            s.commit()
+            return json_response({"ok": False, "error": "job queue unavailable"}), 503
 
-    return jsonify({"ok": True, "job_id": job_id})
+    return json_response({"ok": True, "job_id": job_id})
 
 @app.get("/api/status/<job_id>")
 def status(job_id):
     with Session(engine) as s:
-        r = s.get(Run, job_id)
+        r = load_run(s, job_id)
         if not r:
-            return jsonify({"ok": False, "error": "not found"}), 404
-        _ = r.stages, r.artifacts
-        return jsonify({"ok": True, "job": run_to_dict(r)})
+            return json_response({"ok": False, "error": "not found"}), 404
+        return json_response({"ok": True, "job": run_to_dict(r)})
 
 @app.get("/api/runs/<job_id>")
 def get_run(job_id):
     """Return a single run as a plain JSON object for the report page."""
     with Session(engine) as s:
-        r = s.get(Run, job_id)
+        r = load_run(s, job_id)
         if not r:
-            return jsonify({"error": "not found"}), 404
-        _ = r.stages, r.artifacts
-        return jsonify(run_to_dict(r))
+            return json_response({"error": "not found"}), 404
+        return json_response(run_to_dict(r))
 
 @app.get("/api/artifact")
 def artifact():
     path = request.args.get("path")
     if not path:
-        return jsonify({"ok": False, "error": "missing path"}), 400
+        return json_response({"ok": False, "error": "missing path"}), 400
 
     full = Path(path).resolve()
     if not full.exists():
-        return jsonify({"ok": False, "error": "not found"}), 404
+        return json_response({"ok": False, "error": "not found"}), 404
 
     return send_file(full, conditional=True)
 
@@ -252,17 +401,20 @@ def serve_qc(job_id, rest):
     base = (QC_ROOT / job_id).resolve()
     full = (base / rest).resolve()
     if not str(full).startswith(str(base)) or not full.exists():
-        return jsonify({"ok": False, "error": "not found"}), 404
+        return json_response({"ok": False, "error": "not found"}), 404
     return send_file(full, conditional=True)
 
 # ---------------------------------
 # PIPELINE IMPLEMENTATION
 # ---------------------------------
 def _run_pipeline_real(job_id: str):
+    # RQ runs each job in a forked work horse; never reuse the parent's pooled connections
+    engine.dispose(close=False)
+
     with Session(engine) as s:
         r = s.get(Run, job_id)
 
-        files = json.loads(r.sample_files_json)
+        files = orjson.loads(r.sample_files_json)
         if not files:
             _emit_stage(s, r, "error", 100, {"error": "no FASTQ files"}, status="failed")
             return
@@ -278,44 +430,146 @@ def _run_pipeline_real(job_id: str):
         # 1) RAW FASTQC
         raw_dir = work / "fastqc_raw"
         raw_dir.mkdir(exist_ok=True)
-        sh(["fastqc", str(r1), "-o", str(raw_dir), "--extract", "--quiet"])
-        if r2:
-            sh(["fastqc", str(r2), "-o", str(raw_dir), "--extract", "--quiet"])
+        raw_inputs = [str(r1)] + ([str(r2)] if r2 else [])
+        sh([
+            "fastqc", *raw_inputs,
+            "-t", str(len(raw_inputs)),
+            "-o", str(raw_dir), "--quiet"
+        ])
 
         raw_html = raw_dir / f"{prefix}_fastqc.html"
-        img_dir = raw_dir / f"{prefix}_fastqc" / "Images"
-        metrics = parse_fastqc_summary(raw_dir / f"{prefix}_fastqc")
+        raw_zip = raw_dir / f"{prefix}_fastqc.zip"
+        metrics = parse_fastqc_summary(raw_zip)
 
         _emit_stage(s, r, "pre_fastqc", 15, metrics, raw_html)
-        _add_fastqc_plots(s, r, img_dir, "raw")
+        _add_fastqc_plots(s, r, raw_zip, "raw")
 
-        # 2) fastp
+        # 2) fastp -> STAR
+        # fastp writes uncompressed reads into named pipes that STAR consumes
+        # directly; the gzipped copy on disk is only kept for post-FASTQC.
         trim_dir = work / "trim"
         trim_dir.mkdir(exist_ok=True)
         trimmed_r1 = trim_dir / f"{prefix}_trimmed.fastq.gz"
-        trimmed_r2 = None
+        trimmed_r2 = trim_dir / f"{prefix}_trimmed_R2.fastq.gz" if r2 else None
 
         fastp_html = work / f"{prefix}_fastp.html"
         fastp_json = work / f"{prefix}_fastp.json"
 
+        star_dir = work / "star"
+        star_dir.mkdir(exist_ok=True)
+        star_prefix = star_dir / prefix
+
+        star_threads, fastp_threads, pigz_threads = fused_threads(2 if r2 else 1)
+
+        fastp_fifos, star_fifos, tees = [], [], []
+        for mate, gz in (("R1", trimmed_r1), ("R2", trimmed_r2)):
+            if gz is None:
+                continue
+            fastp_fifo = trim_dir / f"{prefix}_{mate}.fastp.fq"
+            star_fifo = trim_dir / f"{prefix}_{mate}.star.fq"
+            for fifo in (fastp_fifo, star_fifo):
+                fifo.unlink(missing_ok=True)
+                os.mkfifo(fifo)
+            fastp_fifos.append(fastp_fifo)
+            star_fifos.append(star_fifo)
+            tees.append(tee_fifo(fastp_fifo, star_fifo, gz, pigz_threads))
+
         if r2:
-            trimmed_r2 = trim_dir / f"{prefix}_trimmed_R2.fastq.gz"
-            sh([
+            fastp_cmd = [
                 "fastp", "-i", str(r1), "-I", str(r2),
-                "-o", str(trimmed_r1), "-O", str(trimmed_r2),
-                "-h", str(fastp_html), "-j", str(fastp_json), "-w", "4"
-            ])
+                "-o", str(fastp_fifos[0]), "-O", str(fastp_fifos[1]),
+                "-h", str(fastp_html), "-j", str(fastp_json), "-w", str(fastp_threads)
+            ]
         else:
-            sh([
+            fastp_cmd = [
                 "fastp", "-i", str(r1),
-                "-o", str(trimmed_r1),
-                "-h", str(fastp_html), "-j", str(fastp_json), "-w", "4"
-            ])
+                "-o", str(fastp_fifos[0]),
+                "-h", str(fastp_html), "-j", str(fastp_json), "-w", str(fastp_threads)
+            ]
+
+        star_cmd = [
+            "STAR", "--runThreadN", str(star_threads),
+            "--genomeDir", str(STAR_GENOME_DIR),
+            "--genomeLoad", STAR_GENOME_LOAD,
+            "--readFilesIn", *map(str, star_fifos),
+            "--outSAMtype", "BAM", "SortedByCoordinate",
+            "--outSAMunmapped", "Within",
+            "--limitBAMsortRAM", STAR_BAM_SORT_RAM,
+            "--outFileNamePrefix", str(star_prefix)
+        ]
+
+        star_stdout = (star_dir / "stdout.log").open("wb")
+        star = subprocess.Popen(
+            star_cmd, cwd=star_dir,
+            stdout=star_stdout, stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+        star_stdout.close()
+        fastp = subprocess.Popen(
+            fastp_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+
+        # If either end of the pipes dies early the other side blocks forever
+        # (on a FIFO open or a full pipe), so the first failure tears down the
+        # rest of the stage and is the one reported.
+        teardown = threading.Lock()
+        failed = []
+
+        def abort(culprit, procs):
+            with teardown:
+                if failed:
+                    return
+                failed.append(culprit)
+            for p in procs:
+                kill_group(p)
+
+        # Waiting on STAR in the background lets post-FASTQC overlap with the
+        # tail of the alignment (BAM sorting) once fastp is done.
+        def finish_star():
+            code, err = wait_tail(star)
+            if code != 0:
+                abort("star", (fastp, *tees))
+            return code, err
+
+        pool = ThreadPoolExecutor(max_workers=1)
+        star_job = pool.submit(finish_star)
+        pool.shutdown(wait=False)
+
+        fastp_code, fastp_err = wait_tail(fastp)
+        if fastp_code != 0:
+            # e.g. bad input: fastp never opened its outputs, so tee and STAR
+            # are still waiting on their FIFOs. A pigz that died mid-stream also
+            # ends here (fastp gets SIGPIPE), so blame it if it already exited.
+            culprit = "pigz" if any(t.poll() not in (None, 0) for t in tees) else "fastp"
+            abort(culprit, (*tees, star))
+        tee_results = [wait_tail(t) for t in tees]
+        if any(code != 0 for code, _ in tee_results):
+            # pigz failed (e.g. disk full): the trimmed copy is truncated
+            abort("pigz", (star,))
+        for fifo in (*fastp_fifos, *star_fifos):
+            fifo.unlink(missing_ok=True)
+
+        if failed:
+            code, err = star_job.result()
+            if failed[0] == "star":
+                _emit_stage(s, r, "align_star", 100, {"error": err}, star_dir, status="failed")
+            elif failed[0] == "pigz":
+                # prefer the pigz that reported why over ones killed in the teardown
+                code, err = max(((c, e) for c, e in tee_results if c != 0), key=lambda ce: bool(ce[1]))
+                _emit_stage(s, r, "trim_fastp", 100,
+                            {"error": err or f"pigz exited with code {code}"},
+                            trim_dir, status="failed")
+            else:
+                _emit_stage(s, r, "trim_fastp", 100,
+                            {"error": fastp_err or f"fastp exited with code {fastp_code}"},
+                            fastp_html, status="failed")
+            return
 
         fp_metrics = {}
         if fastp_json.exists():
             try:
-                fp_metrics = json.loads(fastp_json.read_text())["summary"]
+                fp_metrics = orjson.loads(fastp_json.read_bytes())["summary"]
             except Exception:
                 fp_metrics = {"note": "could not parse fastp json"}
 
@@ -325,39 +579,23 @@ def _run_pipeline_real(job_id: str):
         post_dir = work / "fastqc_post"
         post_dir.mkdir(exist_ok=True)
 
+        post_inputs = [str(trimmed_r1)] + ([str(trimmed_r2)] if trimmed_r2 else [])
         sh([
-            "fastqc",
-            str(trimmed_r1),
-            "-o", str(post_dir),
-            "--extract", "--quiet"
+            "fastqc", *post_inputs,
+            "-t", str(len(post_inputs)),
+            "-o", str(post_dir), "--quiet"
         ])
 
         post_prefix = Path(trimmed_r1.name).with_suffix("").with_suffix("").name
         post_html = post_dir / f"{post_prefix}_fastqc.html"
-        post_img_dir = post_dir / f"{post_prefix}_fastqc" / "Images"
-        post_metrics = parse_fastqc_summary(post_dir / f"{post_prefix}_fastqc")
+        post_zip = post_dir / f"{post_prefix}_fastqc.zip"
+        post_metrics = parse_fastqc_summary(post_zip)
 
         _emit_stage(s, r, "post_fastqc", 65, post_metrics, post_html)
-        _add_fastqc_plots(s, r, post_img_dir, "post")
+        _add_fastqc_plots(s, r, post_zip, "post")
 
         # 4) STAR ALIGNMENT
-        star_dir = work / "star"
-        star_dir.mkdir(exist_ok=True)
-        star_prefix = star_dir / prefix
-
-        star_cmd = [
-            "STAR", "--runThreadN", "4",
-            "--genomeDir", str(STAR_GENOME_DIR),
-            "--readFilesIn", str(trimmed_r1),
-            "--readFilesCommand", "gunzip", "-c",
-            "--outSAMtype", "BAM", "SortedByCoordinate",
-            "--outFileNamePrefix", str(star_prefix)
-        ]
-
-        if trimmed_r2:
-            star_cmd.insert(star_cmd.index("--readFilesCommand"), str(trimmed_r2))
-
-        code, out, err = sh(star_cmd, cwd=star_dir)
+        code, err = star_job.result()
         if code != 0:
             _emit_stage(s, r, "align_star", 100, {"error": err}, star_dir, status="failed")
             return
@@ -367,21 +605,22 @@ def _run_pipeline_real(job_id: str):
         star_metrics = parse_star_log(star_log)
 
         star_report = star_dir / "star_report.html"
-        with star_report.open("w") as f:
-            f.write("<html><head><title>STAR Report</title>")
-            f.write("<style>table{border-collapse:collapse}"
-                    "td,th{border:1px solid #ccc;padding:4px}</style>")
-            f.write("</head><body>")
-            f.write(f"<h2>STAR Alignment</h2><p>BAM: {bam.name}</p>")
-            f.write("<table><tr><th>Metric</th><th>Value</th></tr>")
-            for k, v in star_metrics.items():
-                f.write(f"<tr><td>{k}</td><td>{v}</td></tr>")
-            f.write("</table></body></html>")
-
-        s.add(Artifact(run_id=r.id, kind="star_bam", path=str(bam)))
-        s.add(Artifact(run_id=r.id, kind="star_report", path=str(star_report)))
-        s.commit()
+        rows = "".join(f"<tr><td>{k}</td><td>{v}</td></tr>" for k, v in star_metrics.items())
+        star_report.write_text(
+            "<html><head><title>STAR Report</title>"
+            "<style>table{border-collapse:collapse}"
+            "td,th{border:1px solid #ccc;padding:4px}</style>"
+            "</head><body>"
+            f"<h2>STAR Alignment</h2><p>BAM: {bam.name}</p>"
+            "<table><tr><th>Metric</th><th>Value</th></tr>"
+            f"{rows}"
+            "</table></body></html>"
+        )
 
+        s.add_all([
+            Artifact(run_id=r.id, kind="star_bam", path=str(bam)),
+            Artifact(run_id=r.id, kind="star_report", path=str(star_report)),
+        ])
         _emit_stage(s, r, "align_star", 85, star_metrics, star_report)
 
         # 5) FEATURECOUNTS
@@ -390,20 +629,18 @@ def _run_pipeline_real(job_id: str):
         counts_out = counts_dir / f"{prefix}_featurecounts.txt"
 
         fc_cmd = [
-            "featureCounts", "-T", "4",
+            "featureCounts", "-T", str(FC_THREADS),
             "-a", str(GTF_PATH),
             "-o", str(counts_out),
             str(bam)
         ]
 
-        code, out, err = sh(fc_cmd, cwd=counts_dir)
+        code, err = sh(fc_cmd, cwd=counts_dir)
         if code != 0:
             _emit_stage(s, r, "featurecounts", 100, {"error": err}, counts_dir, status="failed")
             return
 
         s.add(Artifact(run_id=r.id, kind="counts_table", path=str(counts_out)))
-        s.commit()
-
         _emit_stage(s, r, "featurecounts", 95, {"note": "featureCounts complete"}, counts_out)
 
         # 6) SUMMARY
@@ -0,0 +1,15 @@
+import atexit
+
+from rq import Worker
+
+from app import queue, star_genome
+
+# ---------------------------------
+# Pipeline worker
+# ---------------------------------
+# Run JOB_CONCURRENCY of these; each job sizes its tools to nproc // JOB_CONCURRENCY.
+# Each worker keeps the STAR genome resident across the jobs it processes.
+if __name__ == "__main__":
+    star_genome("LoadAndExit")
+    atexit.register(star_genome, "Remove")
+    Worker([queue], connection=queue.connection).work()